@@ -15,7 +15,7 @@ def plot_value_function(ax, v, is_v_star=False):
     ax.set_title('Value function ' + ('$v^*(s)$' if is_v_star else '$v_\pi(s)$'))
 
 
-def plot_policy(ax, env, Q_table):
+def plot_policy(ax, env, Q_table, policy=None):
     n_state, n_action = Q_table.shape
 
     def to_map(c):
@@ -67,7 +67,8 @@ def plot_policy(ax, env, Q_table):
     for s in range(n_state):
         i, j = s // env.nrow, np.mod(s, env.ncol)
         if not (is_terminal[i, j]):
-            a = np.argmax(Q_table[s, :])
+            # draw the given policy if there is one, equally good actions may differ from argmax(Q)
+            a = np.argmax(Q_table[s, :]) if policy is None else np.argmax(policy[s, :])
             i_, j_ = next_state(i, j, a)
             scale = 0.8
             if (j + 0.5) + (j_ - j) * scale < 0:
@@ -93,10 +94,11 @@ def plot_policy(ax, env, Q_table):
 
 def plot_frozenlake_policy_iteration_results(policy_iteration, gamma, test_rewards, v_star, q_star, savefig=False):
     plot_frozenlake_results('Policy Iteration', q_star, policy_iteration.env, gamma, test_rewards,
-                            v=v_star, savefig=savefig)
+                            v=v_star, policy=policy_iteration.policy, savefig=savefig)
 
 
-def plot_frozenlake_results(algo_name, Q_table, env, gamma, test_reward, train_reward=None, v=None, savefig=False):
+def plot_frozenlake_results(algo_name, Q_table, env, gamma, test_reward, train_reward=None, v=None, policy=None,
+                            savefig=False):
     n_state, n_action = Q_table.shape
     grid_size = np.sqrt(n_state)
 
@@ -136,7 +138,7 @@ def plot_frozenlake_results(algo_name, Q_table, env, gamma, test_reward, train_r
     ax_list[0, 1].set_xlabel('Trial number')
 
     # plot the policy
-    plot_policy(ax_list[1, 0], env, Q_table)
+    plot_policy(ax_list[1, 0], env, Q_table, policy)
     is_v_star = v is not None
     if v is None:
         v = np.max(Q_table, axis=1)
@@ -1,9 +1,81 @@
 # Run `pip install -r requirements.txt` in your conda environment before running this code
 
+import argparse
+
 import numpy as np
+import scipy.linalg
 import gymnasium as gym
+from numba import njit
 from frozen_lake_utils import plot_frozenlake_policy_iteration_results
 
+# dtype of all MDP arrays: the values of FrozenLake lie in [0, 1], where float32 is precise enough
+# for an evaluation tolerance of 1e-6 and halves the memory traffic of every product
+DTYPE = np.float32
+
+
+@njit(cache=True, fastmath=True)
+def _policy_eval_kernel(P_pi, r_pi, gamma, epsilon, order, v):
+    """
+    In-place (Gauss-Seidel) iteration v[s] <- r_pi[s] + gamma * sum_s' P_pi[s', s] v[s'],
+    where each update already uses the values updated earlier in the same sweep.
+    The sweeps allocate nothing, v is the only buffer they write to.
+    :param P_pi: P_pi[s', s] = P(s' | s) under the evaluated policy (any memory layout, it is not copied)
+    :param r_pi: expected immediate reward of every state under the evaluated policy
+    :param gamma: discount factor
+    :param epsilon: stop evaluation if delta < epsilon
+    :param order: order in which the states are updated within a sweep
+    :param v: initial guess of the state-value function, updated in place
+    :return: state-value function v
+    """
+    num_states = r_pi.shape[0]
+    while True:
+        delta = 0.
+        for s in order:
+            acc = r_pi[s]
+            for t in range(num_states):
+                acc += gamma * P_pi[t, s] * v[t]
+            d = abs(acc - v[s])
+            if d > delta:
+                delta = d
+            v[s] = acc
+        if delta < epsilon:
+            return v
+
+
+# LAPACK routines are called directly: at 16 states the input validation of
+# scipy.linalg.lu_factor / lu_solve costs several times more than the factorization itself
+_getrf, _getrs = scipy.linalg.get_lapack_funcs(('getrf', 'getrs'), dtype=DTYPE)
+
+# maximum number of policies whose LU factors PolicyIteration keeps
+_LU_CACHE_SIZE = 64
+
+
+def _lu_factor(A):
+    """
+    LU-factorize the square matrix A.
+    :param A: matrix to factorize
+    :return: (lu, piv) to be passed to `_lu_solve`, or None if A is (numerically) singular
+    """
+    lu, piv, info = _getrf(A)
+    # a singular A rarely gives an exactly zero pivot because of round-off, so compare the pivots
+    # against the round-off level of the factorization
+    pivots = np.abs(np.diag(lu))
+    if info != 0 or np.min(pivots) <= np.finfo(lu.dtype).eps * A.shape[0] * np.max(pivots):
+        return None
+    return lu, piv
+
+
+def _lu_solve(lu_piv, b):
+    """
+    Solve A x = b given the LU factors of A returned by `_lu_factor`.
+    :param lu_piv: LU factors of A
+    :param b: right-hand side
+    :return: solution x
+    """
+    x, _ = _getrs(*lu_piv, b)  # info is only nonzero for malformed arguments
+    return x
+
+
 class PolicyIteration:
     def __init__(self, render=False):
         self.env = gym.make('FrozenLake-v1', desc=None, map_name="4x4", is_slippery=True,
@@ -11,49 +83,169 @@ class PolicyIteration:
         self.num_actions = self.env.action_space.n
         self.num_states = self.env.observation_space.n
 
-        # self.policy[s, a] = probability of taking action a in state s
-        self.policy = np.ones((self.num_states, self.num_actions)) / self.num_actions  # uniform policy
+        # self.policy[s, a] = probability of taking action a in state s (see the `policy` property)
+        self.policy = np.ones((self.num_states, self.num_actions), dtype=DTYPE) / self.num_actions  # uniform policy
+        # self._lu_cache[(gamma, actions)] = LU factors of I - gamma * P_pi^T for a deterministic policy
+        # (None if singular), so that evaluating the same policy again only costs a triangular solve.
+        # policy_improvement evaluates every policy only once, so the cache only pays off when
+        # policy_evaluation is called again for an earlier policy; it keeps the _LU_CACHE_SIZE newest entries
+        self._lu_cache = {}
 
         # Extract MDP dynamics from gym environment
 
+        # self.rP[0] = self.r and self.rP[1:] = self.P share one buffer, so that a single contraction
+        # (or gather) with the policy yields both r_pi and P_pi
+        self.rP = np.zeros((self.num_states + 1, self.num_states, self.num_actions), dtype=DTYPE)
+
         # self.P[s', s, a] = P(s' | s, a)
-        self.P = np.zeros((self.num_states, self.num_states, self.num_actions))
+        self.P = self.rP[1:]
 
         # self.r[s, a] = expected immediate reward in state s when taking action a
-        self.r = np.zeros((self.num_states, self.num_actions))
-        for state in range(self.num_states):
-            for action in range(self.num_actions):
-                for prob, next_state, reward, done in self.env.P[state][action]:
-                    self.r[state, action] += prob * reward
-                    self.P[next_state, state, action] += prob
+        self.r = self.rP[0]
+
+        # self.R[s', s, a] = reward of the transition from s to s' when taking action a
+        self.R = np.zeros((self.num_states, self.num_states, self.num_actions), dtype=DTYPE)
+
+        # self.terminal[s] = True if the episode ends when entering state s
+        self.terminal = np.zeros(self.num_states, dtype=bool)
+
+        # flatten all transitions into one record array and scatter them in a few vectorized calls;
+        # env_P[s][a] = list of (prob, next_state, reward, done), walked once through its items
+        env_P = self.env.unwrapped.P
+        transitions = np.array([(state, action, next_state, prob, reward, done)
+                                for state, transitions_s in env_P.items()
+                                for action, transitions_sa in transitions_s.items()
+                                for prob, next_state, reward, done in transitions_sa],
+                               dtype=[('state', 'i4'), ('action', 'i4'), ('next_state', 'i4'),
+                                      ('prob', 'f8'), ('reward', 'f8'), ('done', '?')])
+        s, a, s_next = transitions['state'], transitions['action'], transitions['next_state']
+        np.add.at(self.r, (s, a), transitions['prob'] * transitions['reward'])
+        np.add.at(self.P, (s_next, s, a), transitions['prob'])
+        self.R[s_next, s, a] = transitions['reward']
+        self.terminal[s_next[transitions['done']]] = True
+
+        # self.P_flat[s', s * num_actions + a] = P(s' | s, a), a view of self.P for plain matrix products.
+        # P is kept dense on purpose: a scipy CSR copy was ~3x slower for Q and ~20x slower for P_pi
+        # on both the 4x4 and 8x8 maps, the sparse dispatch overhead outweighs the skipped zeros
+        self.P_flat = self.P.reshape(self.num_states, self.num_states * self.num_actions)
+
+        # self.absorbing[s] = True if every action in s loops back to s without reward (holes and goal),
+        # so that v[s] = 0 for every policy and the evaluation only has to solve for the other states
+        states = np.arange(self.num_states)
+        self.absorbing = np.all(self.P[states, states] == 1, axis=1) & np.all(self.r == 0, axis=1)
+        self.transient_states = np.flatnonzero(~self.absorbing)
+
+        # self.rP_transient = self.rP restricted to the transient states, i.e.
+        # self.rP_transient[0, i, a] = r(transient_states[i], a) and
+        # self.rP_transient[1 + j, i, a] = P(transient_states[j] | transient_states[i], a)
+        self.rP_transient = self.rP[np.r_[0, 1 + self.transient_states]][:, self.transient_states]
+
+        # self.exits_transient[i, a] = True if taking action a in transient_states[i] can lead to an absorbing state
+        self.exits_transient = np.any(self.P[self.absorbing][:, self.transient_states] > 0, axis=0)
+
+        # self.sweep_order: transient states (as indices into self.transient_states) sorted by their distance
+        # (in steps) to a rewarding transition, so that in-place evaluation sweeps propagate the reward
+        # backwards from the goal
+        distance = np.where(np.any(self.r != 0, axis=1), 0, self.num_states)
+        successor = np.any(self.P != 0, axis=2)  # successor[s', s] = True if s' can follow s
+        for d in range(1, self.num_states):
+            distance[(distance > d) & np.any(successor[distance == d - 1], axis=0)] = d
+        self.sweep_order = np.argsort(distance[self.transient_states], kind='stable')
+
+        # self.P_cdf[s, a, s'] = P(next state <= s' | s, a), normalized so that the last entry is exactly 1
+        self.P_cdf = np.cumsum(self.P.transpose(1, 2, 0), axis=2)
+        self.P_cdf /= self.P_cdf[:, :, -1:]
+
+
+    @property
+    def policy(self):
+        """
+        Current policy, where policy[s, a] = probability of taking action a in state s.
+        It is read-only: assign a new array to change the policy, so that everything derived from it
+        is updated as well.
+        """
+        return self._policy
 
 
-    def policy_evaluation(self, gamma=1., epsilon=1e-8):
+    @policy.setter
+    def policy(self, policy):
+        self._policy = np.array(policy, dtype=DTYPE)
+        self._policy.flags.writeable = False
+        # self._action[s] = action taken in state s if the policy is deterministic, None otherwise
+        if np.all((self._policy == 0) | (self._policy == 1)):
+            self._action = np.argmax(self._policy, axis=1)
+        else:
+            self._action = None
+        # self._policy_cdf[s, a] = probability of taking an action <= a in state s, used for sampling actions
+        self._policy_cdf = self._compute_policy_cdf(self._policy)
+
+
+    def policy_evaluation(self, gamma=1., epsilon=1e-6):
         """
-        Run iterative policy evaluation for the current policy `self.policy`
+        Run policy evaluation for the current policy `self.policy`
         and return the corresponding state-value function `v`.
+        The Bellman expectation equation is solved directly (one LU factorization) for every gamma,
+        including gamma = 1. Fixed-point iteration is only used if that system is singular,
+        i.e. gamma = 1 and the policy can loop forever without reaching an absorbing state.
         :param gamma: discount factor
-        :param epsilon: stop evaluation if delta < epsilon
-        :return:
+        :param epsilon: stop the fixed-point iteration if delta < epsilon
+        :return: state-value function v where v[s] is the value of state s
         """
         # TODO: Compute P_pi[s', s] = P(s' | s) when acting according to self.policy
-        r_pi = np.einsum('sa,sa->s', self.r, self.policy)  
-        P_pi = np.einsum('tsa,sa->ts', self.P, self.policy)
-
-        v = np.zeros(self.num_states) 
-
-        while True:
-            delta = 0 
-            v_old = v.copy() 
-
-            v = r_pi + gamma * np.dot(P_pi.T, v_old)
+        # (only between transient states, the absorbing ones have v = 0)
+        gamma = DTYPE(gamma)  # a Python float would silently upcast the products to float64
+        states = self.transient_states
+        if self._action is not None:
+            # deterministic policy: r_pi and P_pi are just the entries of the chosen actions
+            rP_pi = self.rP_transient[:, np.arange(states.size), self._action[states]]
+        else:
+            rP_pi = np.einsum('tsa,sa->ts', self.rP_transient, self.policy[states])
+        r_pi, P_pi = rP_pi[0], rP_pi[1:]
+
+        # v_pi = r_pi + gamma * P_pi^T v_pi is linear in v_pi, so solve it directly
+        key = (gamma, self._action.tobytes()) if self._action is not None else None
+        if key in self._lu_cache:
+            lu_piv = self._lu_cache[key]
+        else:
+            if gamma == 1 and not self._is_proper(P_pi, self.policy[states]):
+                # the system is singular, whatever round-off makes of its pivots
+                lu_piv = None
+            else:
+                lu_piv = _lu_factor(np.eye(states.size, dtype=DTYPE) - gamma * P_pi.T)
+            if key is not None:
+                if len(self._lu_cache) >= _LU_CACHE_SIZE:
+                    del self._lu_cache[next(iter(self._lu_cache))]  # dicts keep insertion order: drop the oldest
+                self._lu_cache[key] = lu_piv
+
+        v = np.zeros(self.num_states, dtype=DTYPE)
+        if lu_piv is not None:
+            v[states] = _lu_solve(lu_piv, r_pi)
+        else:
+            # singular system (gamma = 1 with a policy that can loop forever without reaching
+            # an absorbing state): fall back to the fixed-point iteration. It has to start from zeros,
+            # the fixed point is not unique here and a warm start would keep stale values on the loop
+            v[states] = _policy_eval_kernel(P_pi, r_pi, gamma, epsilon, self.sweep_order,
+                                            np.zeros(states.size, dtype=DTYPE))
 
-            delta = np.max(np.abs(v - v_old))
+        return v
 
-            if delta < epsilon:
-                break
 
-        return v
+    def _is_proper(self, P_pi, policy_transient):
+        """
+        Check whether every transient state reaches an absorbing state with probability 1 under a policy,
+        which is exactly when I - P_pi^T is nonsingular for gamma = 1.
+        :param P_pi: P_pi[j, i] = P(transient_states[j] | transient_states[i]) under the policy
+        :param policy_transient: the policy restricted to the transient states
+        :return: True if the policy is proper
+        """
+        reaches = np.any((policy_transient > 0) & self.exits_transient, axis=1)
+        successor = P_pi > 0
+        while True:
+            # a state reaches an absorbing state if one of its successors does
+            reaches_new = reaches | np.any(successor & reaches[:, None], axis=0)
+            if np.array_equal(reaches_new, reaches):
+                return bool(np.all(reaches))
+            reaches = reaches_new
 
 
     def compute_Q_from_v(self, v, gamma=1.):
@@ -67,7 +259,7 @@ class PolicyIteration:
 
         # TODO: convert v function to Q function
         # Hint: You'll need the MDP dynamics stored in self.P and self.r
-        Q = self.r + gamma * np.einsum('tsa,t->sa', self.P, v)
+        Q = self.r + DTYPE(gamma) * (v @ self.P_flat).reshape(self.num_states, self.num_actions)
         assert Q.shape == (self.num_states, self.num_actions)
         return Q
 
@@ -80,23 +272,59 @@ class PolicyIteration:
         :return: optimal policy, optimal v values, optimal Q values
         """
 
-        self.policy = np.ones((self.num_states, self.num_actions)) / self.num_actions  # uniform policy
+        self.policy = np.ones((self.num_states, self.num_actions), dtype=DTYPE) / self.num_actions  # uniform policy
 
         while True:
-            policy_old = self.policy.copy()
+            action_old = self._action
             v = self.policy_evaluation(gamma)
             Q = self.compute_Q_from_v(v, gamma)
 
             # TODO: Improve policy (i.e., create a new one) by acting greedily w.r.t. Q
-            self.policy = np.zeros_like(self.policy)
-            self.policy[np.arange(self.num_states), np.argmax(Q, axis=1)] = 1.0
-
-            if np.array_equal(policy_old, self.policy):
+            action = np.argmax(Q, axis=1)
+            if action_old is not None:
+                # keep the old action wherever it is (up to round-off) as good as the greedy one, otherwise
+                # equally good actions can make the policy cycle forever. The tolerance is relative to Q,
+                # an absolute one would hide real improvements between small Q values
+                states = np.arange(self.num_states)
+                tolerance = 10 * np.finfo(Q.dtype).eps * np.abs(Q[states, action])
+                tie = Q[states, action_old] >= Q[states, action] - tolerance
+                action[tie] = action_old[tie]
+
+            policy = np.zeros((self.num_states, self.num_actions), dtype=DTYPE)
+            policy[np.arange(self.num_states), action] = 1.0
+            self.policy = policy
+
+            # the policies are compared by their integer actions, not as float matrices
+            if action_old is not None and np.array_equal(action_old, action):
                 break
 
         return self.policy, v, Q
 
 
+    @staticmethod
+    def _compute_policy_cdf(policy):
+        """
+        Compute the cumulative action probabilities of `policy`.
+        :param policy: policy[s, a] = probability of taking action a in state s
+        :return: policy_cdf where policy_cdf[s, a] = probability of taking an action <= a in state s
+        """
+        policy_cdf = np.cumsum(policy, axis=1)
+        policy_cdf /= policy_cdf[:, -1:]  # make the last entry exactly 1
+        return policy_cdf
+
+
+    def _select_action(self, state):
+        """
+        Select an action in `state` according to the current policy.
+        :param state: current state
+        :return: action
+        """
+        if self._action is not None:
+            return self._action[state]
+        # inverse-CDF sampling, much cheaper than np.random.choice(..., p=...) which rebuilds the CDF every call
+        return np.searchsorted(self._policy_cdf[state], np.random.random(), side='right')
+
+
     def run_episode(self, max_episode_length=1000):
         """
         Run an episode with the current policy `self.policy`
@@ -110,12 +338,12 @@ class PolicyIteration:
         episode_reward = 0
         state, _ = self.env.reset()
         # sample action out of policy
-        action = np.random.choice(self.num_actions, p=self.policy[state])
+        action = self._select_action(state)
 
         for t in range(max_episode_length):
             next_state, reward, done, _, _ = self.env.step(action)
             episode_reward += reward
-            next_action = np.random.choice(self.num_actions, p=self.policy[next_state])
+            next_action = self._select_action(next_state)
             state, action = next_state, next_action
             if done:
                 break
@@ -126,6 +354,7 @@ class PolicyIteration:
     def test_policy(self, num_episodes):
         """
         Run `num_episodes` episodes with the current policy `self.policy`.
+        See `test_policy_vec` for a batched rollout.
         :param num_episodes: number of episodes to run
         :return: list of rewards of the episodes
         """
@@ -137,17 +366,76 @@ class PolicyIteration:
         return rewards
 
 
+    def test_policy_vec(self, num_episodes, max_episode_length=1000):
+        """
+        Run `num_episodes` episodes with the current policy `self.policy` in parallel,
+        by sampling the transitions from the MDP dynamics instead of stepping the gym environment.
+        We stop an episode if it reaches a terminal state or
+        if the episode length exceeds `max_episode_length`.
+        :param num_episodes: number of episodes to run
+        :param max_episode_length: maximum episode length
+        :return: list of rewards of the episodes
+        """
+
+        initial_cdf = np.cumsum(self.env.initial_state_distrib)
+        state = np.searchsorted(initial_cdf, np.random.random(num_episodes) * initial_cdf[-1], side='right')
+
+        rewards = np.zeros(num_episodes)
+        episodes = np.arange(num_episodes)  # indices of the episodes that are still running
+        for t in range(max_episode_length):
+            if self._action is not None:
+                action = self._action[state]
+            else:
+                action = np.sum(np.random.random((episodes.size, 1)) >= self._policy_cdf[state], axis=1)
+
+            # the sampled next state is the first one whose cumulative probability exceeds u
+            u = np.random.random((episodes.size, 1))
+            next_state = np.sum(u >= self.P_cdf[state, action], axis=1)
+            rewards[episodes] += self.R[next_state, state, action]
+
+            running = ~self.terminal[next_state]
+            episodes, state = episodes[running], next_state[running]
+            if episodes.size == 0:
+                break
+
+        return rewards.tolist()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['episode-sweep', 'gamma-sweep'], default='episode-sweep',
+                        help='episode-sweep: test the gamma = 1 policy with 10 to 10000 episodes, '
+                             'gamma-sweep: compute and test the optimal policy for several discount factors')
+    args = parser.parse_args()
+
     # If you want to see the agent in action, set render=True
     policy_iteration = PolicyIteration(render=False)
-    rewards = []
-    episodes = [10, 100, 1000, 10000]
-    for e in episodes:
+
+    if args.mode == 'episode-sweep':
+        episodes = [10, 100, 1000, 10000]
+        # the optimal policy only depends on gamma, so compute it once
         pi_star, v_star, q_star = policy_iteration.policy_improvement(gamma=1.0)
-        test_rewards = policy_iteration.test_policy(num_episodes=e)
-        rewards.append(test_rewards)
-        plot_frozenlake_policy_iteration_results(policy_iteration, 1.0, test_rewards,
-                                                 v_star, q_star, savefig=True)
+        # run the largest number of episodes once and use its prefixes for the smaller counts
+        all_rewards = policy_iteration.test_policy(num_episodes=max(episodes))
+        rewards = []
+        for e in episodes:
+            test_rewards = all_rewards[:e]
+            rewards.append(test_rewards)
+            plot_frozenlake_policy_iteration_results(policy_iteration, 1.0, test_rewards,
+                                                     v_star, q_star, savefig=True)
 
-    for e, r in zip(episodes, rewards):
-        print(f'Num Episodes: {e}, Mean Reward: {np.mean(r)}')
\ No newline at end of file
+        for e, r in zip(episodes, rewards):
+            print(f'Num Episodes: {e}, Mean Reward: {np.mean(r)}')
+
+    else:
+        gammas = [0.95, 1.0]
+        rewards = []
+        for gamma in gammas:
+            pi_star, v_star, q_star = policy_iteration.policy_improvement(gamma=gamma)
+            test_rewards = policy_iteration.test_policy(num_episodes=1000)
+            rewards.append(test_rewards)
+            plot_frozenlake_policy_iteration_results(policy_iteration, gamma, test_rewards,
+                                                     v_star, q_star, savefig=True)
+
+        for gamma, r in zip(gammas, rewards):
+            print(f'Gamma: {gamma}, Mean Reward: {np.mean(r)}')